@@ -1,19 +1,38 @@
 import yaml
 import peewee
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
+import os
 import shlex
 import subprocess
 import sys
 from pathlib import Path
-from typing import Callable, Optional, List, Iterable, Tuple
+from typing import Callable, Optional, List, Iterable, Tuple, Set
 from straight.plugin import load
 
+from magpie.archive import (
+    ArchiveReader,
+    ArchiveWriter,
+    load_checkpoint,
+    reference_key,
+    save_checkpoint,
+)
+
 __version__ = "dev~"
 
 HOME = Path.home()
 CONFIG_FILE_NAME = ".magpie.yml"
-DEFAULT_CONFIGURATION = {"adapter.class": "DBReferenceAdapter"}
+DEFAULT_CONFIGURATION = {
+    "adapter.class": "DBReferenceAdapter",
+    # retention rules applied by `magpie gc`
+    "gc.branches": ["master", "main"],
+    "gc.keep_all_days": 90,
+    "gc.keep_daily_days": None,  # keep the daily tips forever
+    "gc.branch_days": 14,
+    "gc.batch_size": 500,
+    # records per insert (import) or per query (export) of `magpie export|import`
+    "archive.batch_size": 100,
+}
 
 
 def get_output(command, working_folder=None):
@@ -87,6 +106,22 @@ class GitAdapter(object):
         command = "git rev-parse --show-toplevel"
         return get_output(command, working_folder=self.repository_folder).rstrip()
 
+    def get_first_parent_commits(self, refs: List[str]) -> Set[str]:
+        commits = set()
+        for ref in refs:
+            try:
+                get_output(
+                    "git rev-parse --verify --quiet {}".format(ref),
+                    working_folder=self.repository_folder,
+                )
+            except subprocess.CalledProcessError:
+                logging.debug("Reference %s not found", ref)
+                continue
+            command = "git rev-list --first-parent {}".format(ref)
+            output = get_output(command, working_folder=self.repository_folder)
+            commits.update(commit for commit in output.split("\n") if commit)
+        return commits
+
     def get_current_branch(self):
         command = "git rev-parse --abbrev-ref HEAD"
         return get_output(command, working_folder=self.repository_folder).rstrip()
@@ -108,6 +143,13 @@ class ReferenceAdapter(object):
     ) -> frozenset:
         raise NotImplementedError
 
+    def find_commits(
+        self, commits: Iterable[str], kind: str = None, subkind: str = None
+    ) -> frozenset:
+        """Return the subset of `commits` for which reference data exists."""
+        known = self.get_commits(kind=kind, subkind=subkind, limit=-1)
+        return frozenset(commit for commit in commits if commit in known)
+
     def log(self, limit=1,) -> frozenset:
         raise NotImplementedError
 
@@ -127,6 +169,95 @@ class ReferenceAdapter(object):
     ):
         raise NotImplementedError
 
+    def gc(self, policy: "RetentionPolicy", dry_run: bool = False) -> dict:
+        raise NotImplementedError
+
+    def iter_references(
+        self, all_repositories: bool = False, after: Optional[list] = None
+    ) -> Iterable[dict]:
+        """Yield the reference data records, with their data, ordered by
+        (repository_id, commit_id, kind, subkind), starting after the
+        (repository_id, commit_id, kind) key `after`."""
+        raise NotImplementedError
+
+    def store_references(self, records: List[dict]):
+        """Insert `records`, ignoring those which already exist."""
+        raise NotImplementedError
+
+
+class RetentionPolicy(object):
+    """Decide which reference data can be dropped.
+
+    Data collected on the main `branches` is entirely kept for `keep_all_days`;
+    past that, only the last data collected each day on a first-parent commit
+    is kept, for `keep_daily_days` (forever, when None). Data collected on any
+    other branch is dropped after `branch_days`.
+
+    Data of a first-parent commit of a main branch is handled as data of a
+    main branch, whatever the branch recorded at collection time: that is
+    `HEAD` on detached checkouts (as on most CI servers), or nothing at all.
+    """
+
+    def __init__(
+        self,
+        branches: List[str],
+        keep_all_days: int,
+        keep_daily_days: Optional[int],
+        branch_days: int,
+        first_parent_commits: Set[str] = None,
+    ):
+        self.branches = set(branches)
+        self.keep_all = timedelta(days=keep_all_days)
+        self.keep_daily = (
+            timedelta(days=keep_daily_days) if keep_daily_days is not None else None
+        )
+        self.keep_branch = timedelta(days=branch_days)
+        self.first_parent_commits = first_parent_commits or set()
+
+    @classmethod
+    def from_config(cls, config: dict, first_parent_commits: Set[str] = None):
+        keep_daily_days = config.get("gc.keep_daily_days")
+        return cls(
+            config.get("gc.branches"),
+            int(config.get("gc.keep_all_days")),
+            int(keep_daily_days) if keep_daily_days is not None else None,
+            int(config.get("gc.branch_days")),
+            first_parent_commits,
+        )
+
+    def expired(
+        self, rows: Iterable[Tuple[str, str, str, str, datetime]], now: datetime = None
+    ) -> Iterable[Tuple[str, str, str]]:
+        """Yield the (commit_id, kind, subkind) of the expired `rows`, given as
+        (commit_id, kind, subkind, branch, collected_at) tuples."""
+        now = now or datetime.utcnow()
+        daily_tips = {}
+        for row in rows:
+            commit_id, kind, subkind, branch, collected_at = row
+            age = now - collected_at
+            if not self._is_main(commit_id, branch):
+                if age > self.keep_branch:
+                    yield commit_id, kind, subkind
+            elif age <= self.keep_all:
+                continue
+            elif self.keep_daily is not None and age > self.keep_daily:
+                yield commit_id, kind, subkind
+            else:
+                day = (kind, subkind, collected_at.date())
+                tip = daily_tips.get(day)
+                if tip is None:
+                    daily_tips[day] = row
+                    continue
+                if self._sort_key(row) > self._sort_key(tip):
+                    daily_tips[day], row = row, tip
+                yield row[:3]
+
+    def _is_main(self, commit_id, branch):
+        return branch in self.branches or commit_id in self.first_parent_commits
+
+    def _sort_key(self, row):
+        return row[0] in self.first_parent_commits, row[4]
+
 
 reference_adapter_plugins = load("magpie.plugins", subclasses=ReferenceAdapter)
 
@@ -139,15 +270,23 @@ def iter_callable(git, ref):
 
 
 def determine_parent_commit(
-    db_commits: frozenset, iter_callable: Callable
+    find_commits: Callable[[List[str]], frozenset], iter_callable: Callable
 ) -> Optional[str]:
     for commits_chunk in iter_callable():
+        db_commits = find_commits(commits_chunk)
         for commit in commits_chunk:
             if commit in db_commits:
                 return commit
     return None
 
 
+def presence_callable(reference_adapter, kind, subkind):
+    def call(commits):
+        return reference_adapter.find_commits(commits, kind=kind, subkind=subkind)
+
+    return call
+
+
 def str_to_class(classname):
     return getattr(sys.modules[__name__], classname)
 
@@ -221,9 +360,6 @@ def choose_and_retrieve(
     consider_uncommitted: bool = False,
     logging_module=logging,
 ):
-    reference_commits = reference_adapter.get_commits(kind=kind, subkind=subkind)
-    logging_module.debug("Found the following reference commits: %r", reference_commits)
-
     common_ancestor = repo_adapter.get_common_ancestor(target_branch)
 
     commit_id = None
@@ -236,8 +372,10 @@ def choose_and_retrieve(
             ref = common_ancestor
 
         commit_id = determine_parent_commit(
-            reference_commits, iter_callable(repo_adapter, ref)
+            presence_callable(reference_adapter, kind, subkind),
+            iter_callable(repo_adapter, ref),
         )
+        logging_module.debug("Found the reference commit %s", commit_id)
 
     if commit_id:
         logging_module.info(f"Retrieving data for reference commit %{commit_id}")
@@ -250,3 +388,95 @@ def choose_and_retrieve(
         write(filepath, reference_data)
     else:
         logging_module.warning("No reference data found.")
+
+
+def normalize_reference(record: dict) -> dict:
+    # a NULL subkind cannot be part of a Postgres primary key, and escapes the
+    # unicity of the sqlite one: archives only hold empty subkinds instead
+    if record["subkind"] is None:
+        record = dict(record, subkind="")
+    return record
+
+
+def export_references(
+    reference_adapter: ReferenceAdapter,
+    archive_path: str,
+    compress: bool = False,
+    all_repositories: bool = False,
+    resume: bool = False,
+    batch_size: int = 100,
+    logging_module=logging,
+) -> int:
+    checkpoint_path = f"{archive_path}.checkpoint"
+    checkpoint = load_checkpoint(checkpoint_path) if resume else None
+
+    if checkpoint:
+        fd = open(archive_path, "r+b")
+        writer = ArchiveWriter.append(fd, checkpoint["offset"])
+        logging_module.info("Resuming the export after %r", checkpoint["key"])
+    else:
+        fd = open(archive_path, "wb")
+        writer = ArchiveWriter.create(fd, compress)
+        checkpoint = {"offset": writer.tell(), "key": None, "count": 0}
+
+    with fd:
+        records = reference_adapter.iter_references(
+            all_repositories=all_repositories, after=checkpoint["key"]
+        )
+        # checkpoints are only taken between two (repository_id, commit_id,
+        # kind) groups, the unit from which iter_references can resume
+        previous_key, pending = None, 0
+        for record in records:
+            key = reference_key(record)
+            if pending >= batch_size and key != previous_key:
+                writer.flush()
+                checkpoint["offset"] = writer.tell()
+                checkpoint["key"] = previous_key
+                save_checkpoint(checkpoint_path, checkpoint)
+                logging_module.debug("%d records exported", checkpoint["count"])
+                pending = 0
+            writer.write(normalize_reference(record))
+            checkpoint["count"] += 1
+            pending += 1
+            previous_key = key
+        writer.flush()
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    logging_module.info("%d records exported to %s", checkpoint["count"], archive_path)
+    return checkpoint["count"]
+
+
+def import_references(
+    reference_adapter: ReferenceAdapter,
+    archive_path: str,
+    resume: bool = False,
+    batch_size: int = 100,
+    logging_module=logging,
+) -> int:
+    checkpoint_path = f"{archive_path}.import-checkpoint"
+    checkpoint = load_checkpoint(checkpoint_path) if resume else None
+    checkpoint = checkpoint or {"offset": None, "count": 0}
+    if checkpoint["offset"]:
+        logging_module.info("Resuming the import at offset %d", checkpoint["offset"])
+
+    with open(archive_path, "rb") as fd:
+        reader = ArchiveReader(fd, checkpoint["offset"])
+        batch = []
+        for record in reader:
+            batch.append(normalize_reference(record))
+            if len(batch) == batch_size:
+                reference_adapter.store_references(batch)
+                checkpoint["offset"] = reader.tell()
+                checkpoint["count"] += len(batch)
+                save_checkpoint(checkpoint_path, checkpoint)
+                logging_module.debug("%d records imported", checkpoint["count"])
+                batch = []
+        if batch:
+            reference_adapter.store_references(batch)
+            checkpoint["count"] += len(batch)
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    logging_module.info("%d records imported from %s", checkpoint["count"], archive_path)
+    return checkpoint["count"]
@@ -0,0 +1,116 @@
+import json
+import os
+import struct
+import zlib
+from datetime import datetime
+from typing import BinaryIO, Iterator, Optional
+
+# An archive is a header (magic, version, flags) followed by one frame per
+# reference data record: the length of the metadata and of the data (">IQ"),
+# the metadata, as JSON, then the data, zlib-compressed when flagged so.
+MAGIC = b"MAGPIE"
+VERSION = 1
+FLAG_COMPRESSED = 0x01
+HEADER = struct.Struct(">6sBB")
+FRAME = struct.Struct(">IQ")
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveWriter(object):
+    def __init__(self, fd: BinaryIO, compress: bool = False):
+        self.fd = fd
+        self.compress = compress
+
+    @classmethod
+    def create(cls, fd: BinaryIO, compress: bool = False) -> "ArchiveWriter":
+        flags = FLAG_COMPRESSED if compress else 0
+        fd.write(HEADER.pack(MAGIC, VERSION, flags))
+        return cls(fd, compress)
+
+    @classmethod
+    def append(cls, fd: BinaryIO, offset: int) -> "ArchiveWriter":
+        """Continue an archive from `offset`, dropping whatever follows it."""
+        fd.seek(0)
+        compress = read_header(fd)
+        fd.truncate(offset)
+        fd.seek(offset)
+        return cls(fd, compress)
+
+    def write(self, record: dict):
+        record = dict(record)
+        data = bytes(record.pop("data"))
+        if self.compress:
+            data = zlib.compress(data)
+        record["collected_at"] = record["collected_at"].isoformat()
+        meta = json.dumps(record).encode("utf-8")
+        self.fd.write(FRAME.pack(len(meta), len(data)))
+        self.fd.write(meta)
+        self.fd.write(data)
+
+    def tell(self) -> int:
+        return self.fd.tell()
+
+    def flush(self):
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+
+def read_header(fd: BinaryIO) -> bool:
+    header = fd.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise ArchiveError("Not a magpie archive: the header is truncated")
+    magic, version, flags = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ArchiveError(f"Not a magpie archive (version {VERSION})")
+    return bool(flags & FLAG_COMPRESSED)
+
+
+class ArchiveReader(object):
+    def __init__(self, fd: BinaryIO, offset: Optional[int] = None):
+        self.fd = fd
+        self.compress = read_header(fd)
+        if offset:
+            fd.seek(offset)
+
+    def __iter__(self) -> Iterator[dict]:
+        while True:
+            frame = self.fd.read(FRAME.size)
+            if not frame:
+                return
+            if len(frame) != FRAME.size:
+                raise ArchiveError(f"Truncated frame at offset {self.tell()}")
+            meta_length, data_length = FRAME.unpack(frame)
+            meta = self.fd.read(meta_length)
+            data = self.fd.read(data_length)
+            if len(meta) != meta_length or len(data) != data_length:
+                raise ArchiveError(f"Truncated record at offset {self.tell()}")
+            record = json.loads(meta)
+            record["collected_at"] = datetime.fromisoformat(record["collected_at"])
+            record["data"] = zlib.decompress(data) if self.compress else data
+            yield record
+
+    def tell(self) -> int:
+        return self.fd.tell()
+
+
+def reference_key(record: dict) -> list:
+    return [record[key] for key in ("repository_id", "commit_id", "kind")]
+
+
+def load_checkpoint(path) -> Optional[dict]:
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, checkpoint: dict):
+    # write then rename, so that an interruption never leaves a partial file
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as fd:
+        json.dump(checkpoint, fd)
+    os.replace(temporary, path)
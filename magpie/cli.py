@@ -1,8 +1,26 @@
 import click
 import logging
 
-from magpie.app import GitAdapter, configuration, adapter_factory, persist, choose_and_retrieve
+from magpie.app import (
+    GitAdapter,
+    ReferenceAdapter,
+    RetentionPolicy,
+    configuration,
+    adapter_factory,
+    persist,
+    choose_and_retrieve,
+    export_references,
+    import_references,
+)
 from magpie.log import annotated_log
+from magpie.server import make_server
+
+
+def require_support(adapter: ReferenceAdapter, method: str, command: str):
+    if getattr(type(adapter), method) is getattr(ReferenceAdapter, method):
+        raise click.ClickException(
+            f"{type(adapter).__name__} does not support `magpie {command}`"
+        )
 
 
 class MagpieTask:
@@ -68,6 +86,77 @@ class MagpieTask:
             for commit in commits:
                 print(commit)
 
+    def gc(self, dry_run):
+        git, repository_id = self._get_git_repository()
+        config = configuration(self.repository)
+        branches = config.get("gc.branches")
+        refs = branches + [f"origin/{branch}" for branch in branches]
+        policy = RetentionPolicy.from_config(
+            config, git.get_first_parent_commits(refs)
+        )
+
+        with adapter_factory(self.reference_adapter_name, config)(
+            repository_id, config
+        ) as adapter:
+            require_support(adapter, "gc", "gc")
+            report = adapter.gc(policy, dry_run=dry_run)
+
+        verb = "Would delete" if dry_run else "Deleted"
+        print(f"{verb} {report['rows']} rows ({report['bytes']} bytes of data).")
+        if report["size_after"] is not None:
+            reclaimed = report["size_before"] - report["size_after"]
+            print(
+                f"Database size: {report['size_before']} -> {report['size_after']} "
+                f"bytes ({reclaimed} bytes reclaimed)."
+            )
+
+    def export(self, archive, compress, all_repositories, resume):
+        repository_id = None
+        if not all_repositories:
+            _, repository_id = self._get_git_repository()
+        config = configuration(self.repository)
+
+        with adapter_factory(self.reference_adapter_name, config)(
+            repository_id, config
+        ) as adapter:
+            require_support(adapter, "iter_references", "export")
+            export_references(
+                adapter,
+                archive,
+                compress=compress,
+                all_repositories=all_repositories,
+                resume=resume,
+                batch_size=int(config.get("archive.batch_size")),
+            )
+
+    def import_(self, archive, resume):
+        config = configuration(self.repository)
+
+        with adapter_factory(self.reference_adapter_name, config)(
+            None, config
+        ) as adapter:
+            require_support(adapter, "store_references", "import")
+            import_references(
+                adapter,
+                archive,
+                resume=resume,
+                batch_size=int(config.get("archive.batch_size")),
+            )
+
+    def serve(self, host, port, workers):
+        config = configuration(self.repository)
+        adapter_name = self.reference_adapter_name or config.get("server.adapter.class")
+        server = make_server(
+            adapter_factory(adapter_name, config), config, host, port, workers
+        )
+        logging.info("Serving %s on %s", adapter_name, server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
 pass_magpie = click.make_pass_decorator(MagpieTask)
 
 
@@ -156,3 +245,66 @@ def retrieve(magpie, target_branch, consider_uncommitted_changes):
 @pass_magpie
 def log(magpie, limit):
     magpie.log(limit)
+
+
+@cli.command()
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="only report what would be deleted.",
+)
+@pass_magpie
+def gc(magpie, dry_run):
+    click.echo(f"gc (in {magpie.repository})")
+    magpie.gc(dry_run)
+
+
+@cli.command()
+@click.option(
+    "--compress", is_flag=True, default=False, help="whether to compress the data."
+)
+@click.option(
+    "--all-repositories",
+    is_flag=True,
+    default=False,
+    help="export the data of every repository, not only of this one.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="continue an interrupted export from its last checkpoint.",
+)
+@click.argument("archive")
+@pass_magpie
+def export(magpie, archive, compress, all_repositories, resume):
+    click.echo(f"export {archive} (in {magpie.repository})")
+    magpie.export(archive, compress, all_repositories, resume)
+
+
+@cli.command(name="import")
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="continue an interrupted import from its last checkpoint.",
+)
+@click.argument("archive")
+@pass_magpie
+def import_(magpie, archive, resume):
+    click.echo(f"import {archive} (in {magpie.repository})")
+    magpie.import_(archive, resume)
+
+
+@cli.command()
+@click.option("--host", help="the address to listen on (default: server.host)")
+@click.option("--port", type=int, help="the port to listen on (default: server.port)")
+@click.option(
+    "--workers",
+    type=int,
+    help="the number of requests served concurrently (default: server.workers)",
+)
+@pass_magpie
+def serve(magpie, host, port, workers):
+    magpie.serve(host, port, workers)
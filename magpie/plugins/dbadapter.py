@@ -1,11 +1,34 @@
+import logging
+import random
+import threading
+import time
 import peewee
-from magpie.app import ReferenceAdapter, HOME, DEFAULT_CONFIGURATION
+from datetime import datetime
+from playhouse.shortcuts import ReconnectMixin
+from magpie.app import ReferenceAdapter, RetentionPolicy, HOME, DEFAULT_CONFIGURATION
 from typing import Callable, Optional, List, Iterable, Tuple
 
 
 SQLITE_FILE_NAME = ".magpie.db"
 DEFAULT_CONFIGURATION["sqlite.dbpath"] = HOME.joinpath(SQLITE_FILE_NAME)
 DEFAULT_CONFIGURATION["database"] = "sqlite"  # also supported: postgresql, mysql
+# WAL lets readers proceed while a writer commits; the busy timeout (seconds)
+# makes concurrent writers wait for the lock instead of failing immediately
+DEFAULT_CONFIGURATION["sqlite.journal_mode"] = "wal"
+DEFAULT_CONFIGURATION["sqlite.busy_timeout"] = 30
+DEFAULT_CONFIGURATION["sqlite.synchronous"] = "normal"
+DEFAULT_CONFIGURATION["sqlite.cache_size"] = -16000  # in KiB, when negative
+# writes failing with an OperationalError (e.g. "database is locked") are
+# retried this many times, waiting retry_backoff * 2^attempt seconds (jittered)
+DEFAULT_CONFIGURATION["dbadapter.retries"] = 5
+DEFAULT_CONFIGURATION["dbadapter.retry_backoff"] = 0.1
+# seconds to wait for a postgresql or mysql server to accept a connection
+DEFAULT_CONFIGURATION["dbadapter.connect_timeout"] = 5
+# seconds during which a failed replica is not read from anymore
+DEFAULT_CONFIGURATION["dbadapter.replica_cooldown"] = 30
+# seconds during which the reads of data an adapter has written go to the
+# primary, so that it sees its own writes whatever the replication lag
+DEFAULT_CONFIGURATION["dbadapter.replica_lag"] = 60
 
 # if you wish to use postgresql or mysql, also provide
 
@@ -14,6 +37,11 @@ DEFAULT_CONFIGURATION["database"] = "sqlite"  # also supported: postgresql, mysq
 # dbadapter.password (str)
 # dbadapter.host (str)
 # dbadapter.port (int)
+# dbadapter.replicas (list), read replicas, each one a mapping overriding any
+#   of the db, user, password, host and port of the primary, e.g.
+#   dbadapter.replicas: [{host: replica-1}, {host: replica-2, port: 5433}]
+# dbadapter.read_your_writes (bool), to send every read to the primary
+#   (reads following a write of the same adapter always go to the primary)
 
 
 class ReferenceData(peewee.Model):
@@ -33,34 +61,90 @@ class ReferenceData(peewee.Model):
         )
 
 
+class ReconnectingMySQLDatabase(ReconnectMixin, peewee.MySQLDatabase):
+    pass
+
+
+class ReconnectingPostgresqlDatabase(ReconnectMixin, peewee.PostgresqlDatabase):
+    reconnect_errors = ReconnectMixin.reconnect_errors + (
+        (peewee.OperationalError, "server closed the connection"),  # psycopg2
+        (peewee.InterfaceError, "connection already closed"),  # psycopg2
+        (peewee.OperationalError, "terminating connection"),  # psycopg3
+        (peewee.OperationalError, "the connection is closed"),  # psycopg3
+    )
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def shared_database(clazz, database, **params) -> peewee.Database:
+    """Return the database object for these connection parameters, creating it
+    once per process: every adapter (e.g. one per repository in `magpie
+    serve`) then shares the model binding and the per-thread connections."""
+    key = (clazz, str(database), repr(sorted(params.items())))
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = clazz(database, **params)
+        return _databases[key]
+
+
 class DBProvider(object):
     def __init__(self, config):
         engine = config.get("database").lower()
+        self._replicas = []
         if engine == "sqlite":
             dbpath = config.get("sqlite.dbpath")
-            self._db = peewee.SqliteDatabase(dbpath)
-            self._db_info = {"engine": engine, "dbpath": dbpath}
+            pragmas = {
+                "journal_mode": config.get("sqlite.journal_mode"),
+                "synchronous": config.get("sqlite.synchronous"),
+                "cache_size": config.get("sqlite.cache_size"),
+            }
+            pragmas = {key: value for key, value in pragmas.items() if value is not None}
+            self._db = shared_database(
+                peewee.SqliteDatabase,
+                dbpath,
+                timeout=float(config.get("sqlite.busy_timeout") or 0),
+                pragmas=pragmas,
+            )
+            self._db_info = {"engine": engine, "dbpath": dbpath, "pragmas": pragmas}
         elif engine in ("postgres", "mysql"):
             db = config["dbadapter.db"]
             user = config.get("dbadapter.user")
             pwd = config.get("dbadapter.password")
             host = config.get("dbadapter.host")
             port = config.get("dbadapter.port")
-            if port:
-                port = int(port)
+            port = int(port) if port else port
+            connect_timeout = config.get("dbadapter.connect_timeout")
+            # long-lived processes (`magpie serve`) outlive idle connections
             clazz = (
-                peewee.PostgresqlDatabase
+                ReconnectingPostgresqlDatabase
                 if engine == "postgres"
-                else peewee.MySQLDatabase
+                else ReconnectingMySQLDatabase
             )
-            self._db = clazz(db, user=user, password=pwd, host=host, port=port)
+
+            def make_database(db, user=user, password=pwd, host=host, port=port):
+                port = int(port) if port else port
+                params = {"user": user, "password": password, "host": host, "port": port}
+                if connect_timeout:
+                    params["connect_timeout"] = int(connect_timeout)
+                return shared_database(clazz, db, **params)
+
+            self._db = make_database(db)
+            self._replicas = [
+                make_database(**{"db": db, **replica})
+                for replica in config.get("dbadapter.replicas") or []
+            ]
             self._db_info = {
                 "engine": engine,
                 "db": db,
                 "user": user,
-                "password": len(pws) * "*",
+                "password": len(pwd or "") * "*",
                 "host": host,
                 "port": port,
+                "replicas": [
+                    replica.connect_params.get("host") for replica in self._replicas
+                ],
             }
         else:
             raise NameError(f"Database engine not supported: {engine}")
@@ -69,22 +153,131 @@ class DBProvider(object):
     def database(self):
         return self._db
 
+    @property
+    def replicas(self) -> List[peewee.Database]:
+        return self._replicas
+
     @property
     def database_info(self):
         return self._db_info
 
 
+def group_key(record: dict) -> list:
+    return [record["repository_id"], record["commit_id"], record["kind"]]
+
+
+def subkind_is(subkind: Optional[str]):
+    # rows persisted before subkinds were normalized may have a NULL subkind
+    if not subkind:
+        return (ReferenceData.subkind == "") | ReferenceData.subkind.is_null()
+    return ReferenceData.subkind == subkind
+
+
+def with_retries(func: Callable, retries: int, backoff: float):
+    """Call `func`, retrying with an exponential backoff while the database
+    reports an operational error, such as a lock held by another writer."""
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except peewee.OperationalError as exc:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            logging.warning("%s: retrying in %.2f seconds", exc, delay)
+            time.sleep(delay)
+
+
 class DBReferenceAdapter(ReferenceAdapter):
     def __init__(self, repository_id, config) -> None:
         super().__init__(repository_id, config)
 
-        self.db = DBProvider(config).database
+        provider = DBProvider(config)
+        self.db = provider.database
+        self.replicas = provider.replicas
+        self.read_your_writes = bool(config.get("dbadapter.read_your_writes"))
+        self.replica_cooldown = float(config.get("dbadapter.replica_cooldown") or 0)
+        self.replica_lag = float(config.get("dbadapter.replica_lag") or 0)
+        self._unhealthy_until = {}
+        # (commit_id, kind, subkind) -> when this adapter has written it
+        self._recent_writes = {}
+        self._recent_writes_lock = threading.Lock()
+        self.retries = int(config.get("dbadapter.retries") or 0)
+        self.retry_backoff = float(config.get("dbadapter.retry_backoff") or 0)
 
-        self.db.connect()
+        # only needed to create the table: queries name their database, as
+        # adapters bound to another database may live in the same process
         ReferenceData.bind(self.db)
+        self._with_retries(self._connect)
+
+    def _connect(self):
+        self.db.connect(reuse_if_open=True)
         self.db.create_tables([ReferenceData])
 
+    def _with_retries(self, func: Callable):
+        def attempt():
+            return self._closing_on_error(self.db, func)
+
+        return with_retries(attempt, self.retries, self.retry_backoff)
+
+    @staticmethod
+    def _closing_on_error(db: peewee.Database, func: Callable, *args):
+        # peewee only reconnects a connection that has been closed: close a
+        # possibly broken one, so that the next call opens a new one
+        try:
+            return func(*args)
+        except (peewee.OperationalError, peewee.InterfaceError):
+            if not db.in_transaction():
+                db.close()
+            raise
+
+    def _written_recently(self, commits=None, kind=None, subkind=None) -> bool:
+        """Whether this adapter has written data of `kind` and `subkind` (of
+        one of `commits`, if given) within the last `replica_lag` seconds."""
+        now = time.monotonic()
+        with self._recent_writes_lock:
+            for key, written_at in list(self._recent_writes.items()):
+                if now - written_at >= self.replica_lag:
+                    del self._recent_writes[key]
+            return any(
+                (commits is None or commit_id in commits)
+                and (kind, subkind or "") == (written_kind, written_subkind)
+                for commit_id, written_kind, written_subkind in self._recent_writes
+            )
+
+    def _read_replicas(self, primary: bool) -> List[peewee.Database]:
+        now = time.monotonic()
+        if primary or self.read_your_writes:
+            return []
+        healthy = [
+            replica
+            for replica in self.replicas
+            if self._unhealthy_until.get(id(replica), 0) <= now
+        ]
+        return random.sample(healthy, len(healthy))
+
+    def _read(self, func: Callable, primary: bool = False):
+        """Call `func` with a database to read from: a random healthy replica
+        first, then the other ones and finally the primary, should they fail.
+        Only the primary is read from when `primary` is set.
+
+        A failing replica is left aside for `replica_cooldown` seconds."""
+        for replica in self._read_replicas(primary):
+            try:
+                return self._closing_on_error(replica, func, replica)
+            except (peewee.OperationalError, peewee.InterfaceError):
+                logging.warning(
+                    "Replica %s failed, trying the next database",
+                    replica.connect_params.get("host") or replica.database,
+                    exc_info=True,
+                )
+                self._unhealthy_until[id(replica)] = (
+                    time.monotonic() + self.replica_cooldown
+                )
+        return self._closing_on_error(self.db, func, self.db)
+
     def __exit__(self, exc_type, exc_value, traceback):
+        for replica in self.replicas:
+            replica.close()
         self.db.close()
 
     def persist(
@@ -96,17 +289,22 @@ class DBReferenceAdapter(ReferenceAdapter):
         kind: str = None,
         subkind: str = None,
     ):
-        try:
-            ReferenceData.create(
+        def create():
+            return ReferenceData.insert(
                 repository_id=self.repository_id,
                 commit_id=commit_id,
                 kind=kind,
-                subkind=subkind,
+                subkind=subkind or "",
                 filepath=filepath,
                 branch=branch,
                 data=data,
                 collected_at=datetime.utcnow(),
-            )
+            ).execute(self.db)
+
+        with self._recent_writes_lock:
+            self._recent_writes[(commit_id, kind, subkind or "")] = time.monotonic()
+        try:
+            self._with_retries(create)
         except peewee.IntegrityError:
             logging.exception(
                 "Another record seems to exist for this repository/commit/kind/subkind"
@@ -118,15 +316,31 @@ class DBReferenceAdapter(ReferenceAdapter):
         query = ReferenceData.select(ReferenceData.commit_id).where(
             ReferenceData.repository_id == self.repository_id,
             ReferenceData.kind == kind,
-            ReferenceData.subkind == subkind,
+            subkind_is(subkind),
         )
         if branch:
             query = query.where(ReferenceData.branch == branch)
 
-        response = set()
-        for item in query.order_by(-ReferenceData.collected_at).limit(limit):
-            response.add(item.commit_id)
-        return response
+        query = query.order_by(-ReferenceData.collected_at).limit(limit)
+        return self._read(
+            lambda db: {item.commit_id for item in query.execute(db)},
+            primary=self._written_recently(kind=kind, subkind=subkind),
+        )
+
+    def find_commits(
+        self, commits: Iterable[str], kind: str = None, subkind: str = None
+    ) -> frozenset:
+        commits = list(commits)
+        query = ReferenceData.select(ReferenceData.commit_id).where(
+            ReferenceData.repository_id == self.repository_id,
+            ReferenceData.kind == kind,
+            subkind_is(subkind),
+            ReferenceData.commit_id.in_(commits),
+        )
+        return self._read(
+            lambda db: frozenset(item.commit_id for item in query.execute(db)),
+            primary=self._written_recently(set(commits), kind, subkind),
+        )
 
     def log(self, limit: int = -1) -> list:
         kinds_fn = peewee.fn.GROUP_CONCAT(ReferenceData.kind)
@@ -140,8 +354,9 @@ class DBReferenceAdapter(ReferenceAdapter):
             .where(ReferenceData.repository_id == self.repository_id,)
             .group_by(ReferenceData.repository_id, ReferenceData.commit_id)
         )
+        rows = self._read(lambda db: list(query.limit(limit).execute(db)))
         response = {}
-        for item in query.limit(limit):
+        for item in rows:
             kinds = item.kinds.split(",")
             subkinds = item.subkinds.split(",")
             response[item.commit_id] = [
@@ -153,15 +368,156 @@ class DBReferenceAdapter(ReferenceAdapter):
     def retrieve_data(
         self, commit_id: str, kind: str = None, subkind: str = None
     ) -> Tuple[Optional[bytes], Optional[str]]:
-        result = (
+        query = (
             ReferenceData.select(ReferenceData.data, ReferenceData.filepath)
             .where(
                 ReferenceData.repository_id == self.repository_id,
                 ReferenceData.commit_id == commit_id,
                 ReferenceData.kind == kind,
-                ReferenceData.subkind == subkind,
+                subkind_is(subkind),
             )
             .order_by(-ReferenceData.collected_at)
-            .get()
         )
+        result = self._read(
+            query.first, primary=self._written_recently({commit_id}, kind, subkind)
+        )
+        if result is None:
+            return None, None
         return result.data, result.filepath
+
+    def gc(self, policy: RetentionPolicy, dry_run: bool = False) -> dict:
+        rows = (
+            ReferenceData.select(
+                ReferenceData.commit_id,
+                ReferenceData.kind,
+                ReferenceData.subkind,
+                ReferenceData.branch,
+                ReferenceData.collected_at,
+            )
+            .where(ReferenceData.repository_id == self.repository_id)
+            .tuples()
+        )
+        expired = list(policy.expired(rows.iterator(self.db)))
+        report = {
+            "rows": len(expired),
+            "bytes": 0,
+            "size_before": self._database_size(),
+            "size_after": None,
+        }
+
+        expired_commits = {}
+        for commit_id, kind, subkind in expired:
+            expired_commits.setdefault((kind, subkind), []).append(commit_id)
+
+        batch_size = int(self.config.get("gc.batch_size"))
+        for (kind, subkind), commits in expired_commits.items():
+            for start in range(0, len(commits), batch_size):
+                condition = (
+                    (ReferenceData.repository_id == self.repository_id)
+                    & (ReferenceData.kind == kind)
+                    & (ReferenceData.subkind == subkind)
+                    & (ReferenceData.commit_id.in_(commits[start : start + batch_size]))
+                )
+                size = (
+                    ReferenceData.select(
+                        peewee.fn.SUM(peewee.fn.LENGTH(ReferenceData.data))
+                    )
+                    .where(condition)
+                    .scalar(self.db)
+                )
+                report["bytes"] += int(size or 0)
+                if not dry_run:
+                    # one short transaction per batch, so that writers are not
+                    # locked out for the whole collection
+                    delete = ReferenceData.delete().where(condition)
+                    self._with_retries(lambda: delete.execute(self.db))
+
+        if not dry_run:
+            self._compact()
+            report["size_after"] = self._database_size()
+        return report
+
+    def iter_references(
+        self, all_repositories: bool = False, after: Optional[list] = None
+    ) -> Iterable[dict]:
+        # keyset pagination on the primary key index: each page is a short
+        # query seeking past the last (repository_id, commit_id, kind) seen, so
+        # that neither side holds more than a page of blobs, and no transaction
+        # stays open between pages. subkind, which may be NULL, is kept out of
+        # the range: the group of the last row of a page is read on its own.
+        batch_size = int(self.config.get("archive.batch_size"))
+        order = (
+            ReferenceData.repository_id,
+            ReferenceData.commit_id,
+            ReferenceData.kind,
+            ReferenceData.subkind,
+        )
+        while True:
+            query = ReferenceData.select().order_by(*order)
+            if all_repositories:
+                if after:
+                    query = query.where(peewee.Tuple(*order[:3]) > peewee.Tuple(*after))
+            else:
+                query = query.where(ReferenceData.repository_id == self.repository_id)
+                if after:
+                    query = query.where(
+                        peewee.Tuple(*order[1:3]) > peewee.Tuple(*after[1:])
+                    )
+            page = query.limit(batch_size).dicts()
+            rows = self._read(lambda db: list(page.execute(db)))
+            if len(rows) < batch_size:
+                yield from rows
+                return
+
+            after = group_key(rows[-1])
+            yield from (row for row in rows if group_key(row) != after)
+            group = (
+                ReferenceData.select()
+                .where(
+                    ReferenceData.repository_id == after[0],
+                    ReferenceData.commit_id == after[1],
+                    ReferenceData.kind == after[2],
+                )
+                .order_by(ReferenceData.subkind)
+                .dicts()
+            )
+            yield from self._read(lambda db: list(group.execute(db)))
+
+    def store_references(self, records: List[dict]):
+        def insert():
+            with self.db.atomic():
+                insert = ReferenceData.insert_many(records).on_conflict_ignore()
+                insert.execute(self.db)
+
+        self._with_retries(insert)
+
+    def _compact(self):
+        table = ReferenceData._meta.table_name
+        if isinstance(self.db, peewee.SqliteDatabase):
+            statements = ["VACUUM", "ANALYZE"]
+        elif isinstance(self.db, peewee.PostgresqlDatabase):
+            statements = [f"VACUUM ANALYZE {table}"]
+        else:
+            statements = [f"OPTIMIZE TABLE {table}"]
+        for statement in statements:
+            logging.debug("Executing %s", statement)
+            self._with_retries(lambda: self.db.execute_sql(statement))
+
+    def _database_size(self) -> Optional[int]:
+        table = ReferenceData._meta.table_name
+        if isinstance(self.db, peewee.SqliteDatabase):
+            query = (
+                "SELECT page_count * page_size "
+                "FROM pragma_page_count(), pragma_page_size()"
+            )
+            params = ()
+        elif isinstance(self.db, peewee.PostgresqlDatabase):
+            query, params = "SELECT pg_total_relation_size(%s)", (table,)
+        else:
+            query = (
+                "SELECT data_length + index_length FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s"
+            )
+            params = (table,)
+        row = self.db.execute_sql(query, params).fetchone()
+        return int(row[0]) if row and row[0] is not None else None
@@ -0,0 +1,243 @@
+import hashlib
+import http.client
+import io
+import json
+import logging
+from pathlib import Path
+from urllib.parse import quote, unquote, urlencode, urlsplit
+from magpie.app import ReferenceAdapter, HOME, DEFAULT_CONFIGURATION
+from magpie.archive import ArchiveReader, ArchiveWriter, reference_key
+from typing import Optional, Iterable, List, Tuple
+
+
+CACHE_FOLDER_NAME = ".magpie-cache"
+DEFAULT_CONFIGURATION["http.cache_dir"] = HOME.joinpath(CACHE_FOLDER_NAME)
+DEFAULT_CONFIGURATION["http.timeout"] = 30
+DEFAULT_CONFIGURATION["http.batch_size"] = 500
+
+# if you wish to use the HTTPReferenceAdapter (`magpie serve`), also provide
+
+# http.url (str) (required), e.g. http://magpie.example.com:8414
+# http.token (str), if the server has been configured with a `server.token`
+
+CHUNK_SIZE = 64 * 1024
+FILEPATH_HEADER = "X-Magpie-Filepath"
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason, body=b""):
+        super().__init__(f"{status} {reason}: {body[:200]!r}")
+        self.status = status
+
+
+class HTTPReferenceAdapter(ReferenceAdapter):
+    def __init__(self, repository_id, config) -> None:
+        super().__init__(repository_id, config)
+
+        url = urlsplit(config["http.url"])
+        self._connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._netloc = url.netloc
+        # export and import (`magpie export --all-repositories`, `magpie import`)
+        # are not bound to a repository
+        self._prefix = "{}/repositories/{}".format(
+            url.path.rstrip("/"), quote(repository_id or "*", safe="")
+        )
+        self._timeout = float(config.get("http.timeout"))
+        self._token = config.get("http.token")
+        self._batch_size = int(config.get("http.batch_size"))
+        self._cache_dir = Path(config.get("http.cache_dir"))
+        self._connection = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def _request(self, method, path, query=None, body=None, headers=None):
+        """Send a request on the kept-alive connection, reconnecting once if the
+        server has closed it in the meantime."""
+        query = {key: value for key, value in (query or {}).items() if value is not None}
+        url = self._prefix + path + ("?" + urlencode(query) if query else "")
+        headers = dict(headers or {})
+        if self._token:
+            headers["Authorization"] = f"Bearer {self._token}"
+
+        for attempt in (0, 1):
+            if self._connection is None:
+                self._connection = self._connection_class(
+                    self._netloc, timeout=self._timeout
+                )
+            try:
+                self._connection.request(method, url, body=body, headers=headers)
+                return self._connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                self._connection.close()
+                self._connection = None
+                if attempt:
+                    raise
+
+    def _json(self, method, path, query=None, payload=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body else {}
+        response = self._request(method, path, query, body, headers)
+        content = response.read()
+        if response.status >= 400:
+            raise HTTPError(response.status, response.reason, content)
+        return json.loads(content)
+
+    def get_commits(
+        self, branch: str = None, kind: str = None, subkind: str = None, limit: int = -1
+    ) -> frozenset:
+        response = self._json(
+            "GET",
+            "/commits",
+            {"branch": branch, "kind": kind, "subkind": subkind, "limit": limit},
+        )
+        return frozenset(response["commits"])
+
+    def find_commits(
+        self, commits: Iterable[str], kind: str = None, subkind: str = None
+    ) -> frozenset:
+        commits = list(commits)
+        found = set()
+        for start in range(0, len(commits), self._batch_size):
+            response = self._json(
+                "POST",
+                "/presence",
+                payload={
+                    "commits": commits[start : start + self._batch_size],
+                    "kind": kind,
+                    "subkind": subkind,
+                },
+            )
+            found.update(response["commits"])
+        return frozenset(found)
+
+    def log(self, limit: int = -1) -> dict:
+        return self._json("GET", "/log", {"limit": limit})["log"]
+
+    def _cache_paths(self, commit_id, kind, subkind):
+        key = json.dumps([self._prefix, self._netloc, commit_id, kind, subkind])
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return (
+            self._cache_dir.joinpath(f"{digest}.json"),
+            self._cache_dir.joinpath(f"{digest}.data"),
+        )
+
+    def retrieve_data(
+        self, commit_id: str, kind: str = None, subkind: str = None
+    ) -> Tuple[Optional[bytes], Optional[str]]:
+        meta_path, data_path = self._cache_paths(commit_id, kind, subkind)
+        headers = {}
+        try:
+            with open(meta_path) as fd:
+                meta = json.load(fd)
+            headers["If-None-Match"] = meta["etag"]
+        except (FileNotFoundError, ValueError, KeyError):
+            meta = None
+
+        response = self._request(
+            "GET",
+            "/data/{}".format(quote(commit_id, safe="")),
+            {"kind": kind, "subkind": subkind},
+            headers=headers,
+        )
+
+        if response.status == 304 and meta:
+            response.read()
+            logging.debug("Reference data for %s is up to date in cache", commit_id)
+            try:
+                with open(data_path, "rb") as fd:
+                    return fd.read(), meta["filepath"]
+            except FileNotFoundError:
+                # the cache has been altered: ask again, unconditionally
+                meta_path.unlink()
+                return self.retrieve_data(commit_id, kind, subkind)
+
+        if response.status == 404:
+            response.read()
+            return None, None
+        if response.status >= 400:
+            raise HTTPError(response.status, response.reason, response.read())
+
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        if meta:
+            meta_path.unlink()
+        chunks = []
+        with open(data_path, "wb") as fd:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fd.write(chunk)
+                chunks.append(chunk)
+        filepath = unquote(response.getheader(FILEPATH_HEADER) or "") or None
+        with open(meta_path, "w") as fd:
+            json.dump({"etag": response.getheader("ETag"), "filepath": filepath}, fd)
+        return b"".join(chunks), filepath
+
+    def persist(
+        self,
+        commit_id: str,
+        data: bytes,
+        filepath: str,
+        branch: str = None,
+        kind: str = None,
+        subkind: str = None,
+    ):
+        response = self._request(
+            "PUT",
+            "/data/{}".format(quote(commit_id, safe="")),
+            {"filepath": filepath, "branch": branch, "kind": kind, "subkind": subkind},
+            body=data,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(len(data)),
+            },
+        )
+        content = response.read()
+        if response.status >= 400:
+            raise HTTPError(response.status, response.reason, content)
+
+    def iter_references(
+        self, all_repositories: bool = False, after: Optional[list] = None
+    ) -> Iterable[dict]:
+        limit = int(self.config.get("archive.batch_size"))
+        while True:
+            response = self._request(
+                "GET",
+                "/references",
+                {
+                    "all": 1 if all_repositories else None,
+                    "after": json.dumps(after) if after else None,
+                    "limit": limit,
+                },
+            )
+            content = response.read()
+            if response.status >= 400:
+                raise HTTPError(response.status, response.reason, content)
+            # each page ends with a complete (repository_id, commit_id, kind) group
+            records = list(ArchiveReader(io.BytesIO(content)))
+            if not records:
+                return
+            yield from records
+            after = reference_key(records[-1])
+
+    def store_references(self, records: List[dict]):
+        buffer = io.BytesIO()
+        writer = ArchiveWriter.create(buffer)
+        for record in records:
+            writer.write(record)
+        response = self._request(
+            "POST",
+            "/references",
+            body=buffer.getvalue(),
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        content = response.read()
+        if response.status >= 400:
+            raise HTTPError(response.status, response.reason, content)
@@ -0,0 +1,405 @@
+import hashlib
+import hmac
+import io
+import json
+import logging
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from magpie.app import DEFAULT_CONFIGURATION, ReferenceAdapter
+from magpie.archive import ArchiveError, ArchiveReader, ArchiveWriter, reference_key
+
+DEFAULT_CONFIGURATION["server.host"] = "127.0.0.1"
+DEFAULT_CONFIGURATION["server.port"] = 8414
+DEFAULT_CONFIGURATION["server.workers"] = 8
+DEFAULT_CONFIGURATION["server.cache_size"] = 128
+# seconds after which cached data is read again from the adapter, so that data
+# deleted by `magpie gc` (or any other client of the database) stops being served
+DEFAULT_CONFIGURATION["server.cache_ttl"] = 300
+DEFAULT_CONFIGURATION["server.adapter.class"] = "DBReferenceAdapter"
+
+# server.token (str): when set, clients must send `Authorization: Bearer <token>`
+
+CHUNK_SIZE = 64 * 1024
+FILEPATH_HEADER = "X-Magpie-Filepath"
+
+
+class BadRequest(Exception):
+    pass
+
+
+def content_etag(data: bytes) -> str:
+    return '"{}"'.format(hashlib.sha256(data).hexdigest())
+
+
+class DataCache(object):
+    """A thread-safe LRU cache of `retrieve_data` results, with their ETag.
+
+    Entries expire `ttl` seconds after having been stored.
+    """
+
+    def __init__(self, size: int, ttl: float = None):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[Tuple[bytes, str, str]]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            stored_at, item = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item
+
+    def put(self, key, data: bytes, filepath: str) -> Tuple[bytes, str, str]:
+        item = (data, filepath, content_etag(data))
+        if self.size <= 0:
+            return item
+        with self._lock:
+            self._items[key] = (time.monotonic(), item)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return item
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class ReferenceServer(ThreadingHTTPServer):
+    """Expose a `ReferenceAdapter` over HTTP.
+
+    Each client connection gets its own (cheap) thread, but the calls to the
+    wrapped adapters all run on a fixed pool of `workers` threads. This bounds
+    the load put on the database, and lets the connections opened by the
+    adapters in those threads be reused across requests and clients.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, adapter_class, config, workers=None):
+        self.adapter_class = adapter_class
+        self.config = config
+        self.token = config.get("server.token")
+        ttl = config.get("server.cache_ttl")
+        self.cache = DataCache(
+            int(config.get("server.cache_size", 0)),
+            float(ttl) if ttl is not None else None,
+        )
+        self._adapters = {}
+        self._adapters_lock = threading.Lock()
+        workers = workers or int(config.get("server.workers", 1))
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="magpie-server"
+        )
+        super().__init__(server_address, ReferenceRequestHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def adapter(self, repository_id: str) -> ReferenceAdapter:
+        with self._adapters_lock:
+            adapter = self._adapters.get(repository_id)
+            if adapter is None:
+                adapter = self.adapter_class(repository_id, self.config)
+                adapter.__enter__()
+                self._adapters[repository_id] = adapter
+            return adapter
+
+    def run(self, repository_id: str, func):
+        """Call `func` with the adapter of `repository_id` on the worker pool."""
+        return self._executor.submit(lambda: func(self.adapter(repository_id))).result()
+
+    def call(self, repository_id: str, method: str, *args, **kwargs):
+        """Call `method` of the adapter of `repository_id` on the worker pool."""
+        return self.run(
+            repository_id, lambda adapter: getattr(adapter, method)(*args, **kwargs)
+        )
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            logging.debug("Connection with %s lost", client_address)
+            return
+        super().handle_error(request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+        with self._adapters_lock:
+            for adapter in self._adapters.values():
+                adapter.__exit__(None, None, None)
+            self._adapters.clear()
+
+
+class ReferenceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "magpie"
+    # close idle keep-alive connections, so that they release their thread
+    timeout = 30
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def end_headers(self):
+        super().end_headers()
+        self.headers_sent = True
+
+    def _dispatch(self, method):
+        self.headers_sent = False
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        self.query = {
+            key: values[-1] for key, values in parse_qs(url.query).items()
+        }
+
+        if self.server.token and not hmac.compare_digest(
+            self.headers.get("Authorization", "").encode("utf-8"),
+            f"Bearer {self.server.token}".encode("utf-8"),
+        ):
+            self._send_error(HTTPStatus.UNAUTHORIZED)
+            return
+
+        routes = {
+            ("GET", "commits", 0): self.get_commits,
+            ("POST", "presence", 0): self.find_commits,
+            ("GET", "log", 0): self.log,
+            ("GET", "data", 1): self.retrieve_data,
+            ("PUT", "data", 1): self.persist,
+            ("GET", "references", 0): self.iter_references,
+            ("POST", "references", 0): self.store_references,
+        }
+        route = None
+        if len(parts) >= 3 and parts[0] == "repositories":
+            route = routes.get((method, parts[2], len(parts) - 3))
+        if route is None:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        try:
+            route(parts[1], *parts[3:])
+        except ConnectionError:
+            raise
+        except Exception as exc:
+            if isinstance(exc, BadRequest):
+                status = HTTPStatus.BAD_REQUEST
+            elif isinstance(exc, NotImplementedError):
+                status = HTTPStatus.NOT_IMPLEMENTED
+            else:
+                logging.exception("Failed to serve %s %s", method, self.path)
+                status = HTTPStatus.INTERNAL_SERVER_ERROR
+            if self.headers_sent:
+                # a response is already underway: the stream can only be closed
+                self.close_connection = True
+            else:
+                self._send_error(status, str(exc))
+
+    def _int_parameter(self, name, default):
+        value = self.query.get(name, default)
+        try:
+            return int(value)
+        except ValueError:
+            raise BadRequest(f"{name} must be an integer, not {value!r}")
+
+    def get_commits(self, repository_id):
+        commits = self.server.call(
+            repository_id,
+            "get_commits",
+            branch=self.query.get("branch"),
+            kind=self.query.get("kind"),
+            subkind=self.query.get("subkind"),
+            limit=self._int_parameter("limit", -1),
+        )
+        self._send_json({"commits": sorted(commits)})
+
+    def find_commits(self, repository_id):
+        try:
+            body = json.loads(self._read_body())
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            raise BadRequest("The request body must be a JSON object")
+        commits = body.get("commits", [])
+        if not isinstance(commits, list) or not all(
+            isinstance(commit, str) for commit in commits
+        ):
+            raise BadRequest("commits must be a list of commit IDs")
+        commits = self.server.call(
+            repository_id,
+            "find_commits",
+            commits,
+            kind=body.get("kind"),
+            subkind=body.get("subkind"),
+        )
+        self._send_json({"commits": sorted(commits)})
+
+    def log(self, repository_id):
+        limit = self._int_parameter("limit", -1)
+        self._send_json({"log": self.server.call(repository_id, "log", limit)})
+
+    def retrieve_data(self, repository_id, commit_id):
+        kind = self.query.get("kind")
+        subkind = self.query.get("subkind")
+        key = (repository_id, commit_id, kind, subkind)
+
+        item = self.server.cache.get(key)
+        if item is None:
+            data, filepath = self.server.call(
+                repository_id, "retrieve_data", commit_id, kind=kind, subkind=subkind
+            )
+            if data is None:
+                self._send_error(HTTPStatus.NOT_FOUND)
+                return
+            item = self.server.cache.put(key, data, filepath)
+
+        data, filepath, etag = item
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self._send_bytes(
+            data,
+            {
+                "ETag": etag,
+                # header values are latin-1: file paths may hold any character
+                FILEPATH_HEADER: quote(filepath or ""),
+            },
+        )
+
+    def persist(self, repository_id, commit_id):
+        kind = self.query.get("kind")
+        subkind = self.query.get("subkind")
+        self.server.call(
+            repository_id,
+            "persist",
+            commit_id,
+            self._read_body(),
+            filepath=self.query.get("filepath"),
+            branch=self.query.get("branch"),
+            kind=kind,
+            subkind=subkind,
+        )
+        self.server.cache.invalidate((repository_id, commit_id, kind, subkind))
+        self._send_json({"commit": commit_id}, status=HTTPStatus.CREATED)
+
+    def iter_references(self, repository_id):
+        """Send, as an archive, the records following the key `after` (JSON):
+        `limit` of them, completed up to the end of their (repository_id,
+        commit_id, kind) group, from which the next page can be asked."""
+        all_repositories = self.query.get("all") == "1"
+        limit = self._int_parameter(
+            "limit", self.server.config.get("archive.batch_size")
+        )
+        if limit <= 0:
+            raise BadRequest("limit must be positive")
+        try:
+            after = json.loads(self.query.get("after", "null"))
+        except ValueError:
+            after = False
+        if after is not None and not (
+            isinstance(after, list)
+            and len(after) == 3
+            and all(isinstance(part, str) for part in after)
+        ):
+            raise BadRequest("after must be a [repository_id, commit_id, kind] key")
+
+        def page(adapter):
+            buffer = io.BytesIO()
+            writer = ArchiveWriter.create(buffer)
+            records = adapter.iter_references(
+                all_repositories=all_repositories, after=after
+            )
+            count, previous_key = 0, None
+            for record in records:
+                key = reference_key(record)
+                if count >= limit and key != previous_key:
+                    break
+                writer.write(record)
+                count += 1
+                previous_key = key
+            return buffer.getvalue()
+
+        self._send_bytes(self.server.run(repository_id, page))
+
+    def store_references(self, repository_id):
+        try:
+            records = list(ArchiveReader(io.BytesIO(self._read_body())))
+        except (ArchiveError, ValueError, KeyError, TypeError, zlib.error) as exc:
+            raise BadRequest(f"Invalid archive: {exc}")
+        if records:
+            self.server.call(repository_id, "store_references", records)
+        self._send_json({"count": len(records)})
+
+    def _read_body(self) -> bytes:
+        remaining = int(self.headers.get("Content-Length", 0))
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def _send_bytes(self, data: bytes, headers=None):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        view = memoryview(data)
+        for offset in range(0, len(data), CHUNK_SIZE):
+            self.wfile.write(view[offset : offset + CHUNK_SIZE])
+
+    def _send_json(self, payload, status=HTTPStatus.OK):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message=None):
+        # the request body may not have been consumed: do not reuse the stream
+        self.close_connection = True
+        # drop the headers of a response which failed before being sent
+        self._headers_buffer = []
+        self._send_json({"error": message or status.phrase}, status=status)
+
+
+def make_server(
+    adapter_class, config, host=None, port=None, workers=None
+) -> ReferenceServer:
+    host = host if host is not None else config.get("server.host")
+    port = port if port is not None else int(config.get("server.port"))
+    return ReferenceServer((host, port), adapter_class, config, workers=workers)
@@ -0,0 +1,11 @@
+import pytest
+
+from magpie.app import DEFAULT_CONFIGURATION
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = dict(DEFAULT_CONFIGURATION)
+    config["sqlite.dbpath"] = str(tmp_path / "magpie.db")
+    config["http.cache_dir"] = str(tmp_path / "cache")
+    return config
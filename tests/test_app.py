@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+from magpie.app import RetentionPolicy
+
+NOW = datetime(2026, 10, 19, 12)
+
+
+def policy(first_parent_commits=None):
+    return RetentionPolicy(["master"], 90, None, 14, first_parent_commits)
+
+
+def row(commit_id, branch, days, hours=0):
+    return commit_id, "cc", "u", branch, NOW - timedelta(days=days, hours=hours)
+
+
+def expired(policy, rows):
+    return {commit_id for commit_id, _, _ in policy.expired(rows, now=NOW)}
+
+
+def test_branch_data_expires():
+    rows = [row("recent", "feature", 10), row("old", "feature", 20)]
+    assert expired(policy(), rows) == {"old"}
+
+
+def test_detached_head_data_is_kept_on_first_parent_commits_only():
+    rows = [row("master", "HEAD", 30), row("feature", "HEAD", 30)]
+    assert expired(policy({"master"}), rows) == {"feature"}
+
+
+def test_data_without_branch_is_kept_on_first_parent_commits_only():
+    rows = [row("master", None, 30), row("feature", None, 30)]
+    assert expired(policy({"master"}), rows) == {"feature"}
+
+
+def test_first_parent_commits_are_kept_whatever_their_branch():
+    rows = [row("c1", "ci-build", 30), row("c2", "ci-build", 30)]
+    assert expired(policy({"c1"}), rows) == {"c2"}
+
+
+def test_old_main_data_is_thinned_to_a_daily_tip():
+    rows = [
+        row("recent", "master", 10),
+        row("first-parent", "master", 100, 3),
+        row("merged", "master", 100, 1),
+        row("late", "master", 100, 2),
+    ]
+    assert expired(policy({"first-parent"}), rows) == {"merged", "late"}
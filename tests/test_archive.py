@@ -0,0 +1,116 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from magpie.app import adapter_factory, export_references, import_references
+from magpie.plugins.dbadapter import ReferenceData
+
+NOW = datetime(2026, 10, 19, 12)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def db_adapter(config, dbpath, repository_id=None):
+    config = dict(config, **{"sqlite.dbpath": str(dbpath), "archive.batch_size": 7})
+    return adapter_factory("DBReferenceAdapter", config)(repository_id, config)
+
+
+def dump(adapter):
+    return [
+        (row["repository_id"], row["commit_id"], row["kind"], row["subkind"], row["data"])
+        for row in adapter.iter_references(all_repositories=True)
+    ]
+
+
+@pytest.fixture
+def source(config, tmp_path):
+    with db_adapter(config, tmp_path / "source.db") as adapter:
+        ReferenceData.insert_many(
+            [
+                dict(
+                    repository_id=f"r{index % 3}",
+                    commit_id=f"c{index // 2}",
+                    kind="cc",
+                    # rows persisted through the API may lack a subkind
+                    subkind=None if index % 4 == 0 else f"s{index % 5}",
+                    branch="master",
+                    data=os.urandom(100),
+                    collected_at=NOW - timedelta(hours=index),
+                    filepath="out.yml",
+                )
+                for index in range(100)
+            ]
+        ).execute()
+        yield adapter
+
+
+def interrupt_after(records, count):
+    for index, record in enumerate(records):
+        if index == count:
+            raise Interrupted()
+        yield record
+
+
+def test_round_trip(source, config, tmp_path):
+    archive = str(tmp_path / "references.mag")
+    assert export_references(source, archive, compress=True, all_repositories=True) == 100
+
+    with db_adapter(config, tmp_path / "destination.db") as destination:
+        assert import_references(destination, archive) == 100
+        # importing again does not duplicate anything
+        import_references(destination, archive)
+
+        expected = [row[:3] + (row[3] or "",) + row[4:] for row in dump(source)]
+        assert sorted(dump(destination)) == sorted(expected)
+        assert ReferenceData.select().count() == 100
+
+    with db_adapter(config, tmp_path / "destination.db", "r0") as destination:
+        assert destination.retrieve_data("c0", "cc", None)[0] is not None
+
+
+def test_resume_an_export(source, config, tmp_path, monkeypatch):
+    archive = str(tmp_path / "references.mag")
+    iter_references = source.iter_references
+    monkeypatch.setattr(
+        source,
+        "iter_references",
+        lambda **kwargs: interrupt_after(iter_references(**kwargs), 40),
+    )
+    with pytest.raises(Interrupted):
+        export_references(source, archive, all_repositories=True, batch_size=7)
+    assert os.path.exists(f"{archive}.checkpoint")
+
+    monkeypatch.setattr(source, "iter_references", iter_references)
+    export_references(source, archive, all_repositories=True, resume=True, batch_size=7)
+    assert not os.path.exists(f"{archive}.checkpoint")
+
+    with db_adapter(config, tmp_path / "destination.db") as destination:
+        assert import_references(destination, archive) == 100
+        assert len(dump(destination)) == 100
+
+
+def test_resume_an_import(source, config, tmp_path):
+    archive = str(tmp_path / "references.mag")
+    export_references(source, archive, all_repositories=True)
+
+    with db_adapter(config, tmp_path / "destination.db") as destination:
+        store_references = destination.store_references
+        calls = []
+
+        def failing_store_references(records):
+            store_references(records)
+            calls.append(len(records))
+            if len(calls) == 4:
+                # stored, but interrupted before the checkpoint
+                raise Interrupted()
+
+        destination.store_references = failing_store_references
+        with pytest.raises(Interrupted):
+            import_references(destination, archive, batch_size=10)
+
+        destination.store_references = store_references
+        assert import_references(destination, archive, resume=True, batch_size=10) == 100
+        assert ReferenceData.select().count() == 100
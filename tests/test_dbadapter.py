@@ -0,0 +1,177 @@
+import multiprocessing
+import random
+import shutil
+from datetime import datetime, timedelta
+
+import peewee
+import pytest
+
+from magpie.app import RetentionPolicy, adapter_factory
+from magpie.plugins.dbadapter import ReferenceData
+
+WRITERS = 16
+WRITES = 40
+
+
+def write(args):
+    config, writer = args
+    with adapter_factory("DBReferenceAdapter", config)("repo", config) as adapter:
+        for index in range(WRITES):
+            adapter.persist(
+                f"{writer}-{index}", b"x" * 10000, "out.yml", kind="cc", subkind="u"
+            )
+            adapter.find_commits([f"{writer}-{index}"], kind="cc", subkind="u")
+
+
+def test_concurrent_writers(config):
+    with multiprocessing.Pool(WRITERS) as pool:
+        pool.map(write, [(config, writer) for writer in range(WRITERS)])
+
+    with adapter_factory("DBReferenceAdapter", config)("repo", config) as adapter:
+        commits = adapter.get_commits(kind="cc", subkind="u")
+
+    assert len(commits) == WRITERS * WRITES
+
+
+class CountingDatabase(peewee.SqliteDatabase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = 0
+        self.connections = 0
+
+    def _connect(self):
+        self.connections += 1
+        return super()._connect()
+
+    def execute_sql(self, *args, **kwargs):
+        self.queries += 1
+        return super().execute_sql(*args, **kwargs)
+
+
+def replicated_adapter(config, tmp_path):
+    adapter = adapter_factory("DBReferenceAdapter", config)("repo", config)
+    adapter.persist("c1", b"data", "out.yml", kind="cc", subkind="u")
+    adapter.db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    shutil.copy(config["sqlite.dbpath"], tmp_path / "replica.db")
+    dead = CountingDatabase(str(tmp_path / "missing" / "dead.db"))
+    replica = CountingDatabase(str(tmp_path / "replica.db"))
+    adapter.replicas = [dead, replica]
+    adapter._recent_writes.clear()
+    return adapter, dead, replica
+
+
+def test_reads_go_to_healthy_replicas(config, tmp_path, monkeypatch):
+    # try the replicas in order: the dead one first
+    monkeypatch.setattr(random, "sample", lambda population, k: list(population))
+    adapter, dead, replica = replicated_adapter(config, tmp_path)
+    with adapter:
+        for _ in range(5):
+            assert adapter.get_commits(kind="cc", subkind="u") == {"c1"}
+
+    assert replica.queries == 5
+    # the dead replica is left aside once it has failed
+    assert dead.connections == 1
+
+
+def test_reads_follow_writes_to_the_primary(config, tmp_path):
+    adapter, dead, replica = replicated_adapter(config, tmp_path)
+    with adapter:
+        adapter.persist("c2", b"data", "out.yml", kind="cc", subkind="u")
+
+        assert adapter.get_commits(kind="cc", subkind="u") == {"c1", "c2"}
+        assert adapter.retrieve_data("c2", "cc", "u") == (b"data", "out.yml")
+
+    assert replica.queries == dead.queries == 0
+
+
+def test_reads_of_other_data_still_go_to_replicas(config, tmp_path):
+    adapter, dead, replica = replicated_adapter(config, tmp_path)
+    adapter.replicas = [replica]
+    with adapter:
+        # as on `magpie serve`, where the adapter of a repository is shared by
+        # the client writing and those reading other data
+        adapter.persist("c2", b"data", "out.yml", kind="cc", subkind="u")
+
+        assert adapter.retrieve_data("c1", "cc", "u") == (b"data", "out.yml")
+        assert adapter.find_commits(["c0", "c1"], "cc", "u") == {"c1"}
+        assert adapter.get_commits(kind="cc", subkind="other") == set()
+        assert adapter.log() == {"c1": ["cc:u"]}
+
+    assert replica.queries == 4
+
+
+def test_adapters_share_their_database(config, tmp_path):
+    other_config = dict(config, **{"sqlite.dbpath": str(tmp_path / "other.db")})
+    factory = adapter_factory("DBReferenceAdapter", config)
+    with factory("a", config) as first, factory("b", config) as second:
+        with factory("a", other_config) as other:
+            assert first.db is second.db
+            assert other.db is not first.db
+
+            # writes go to the adapter's database, whatever was bound last
+            first.persist("c1", b"data", "out.yml", kind="cc", subkind="u")
+            assert first.get_commits(kind="cc", subkind="u") == {"c1"}
+            assert other.get_commits(kind="cc", subkind="u") == set()
+
+
+def test_a_failing_connection_is_reopened(config, monkeypatch):
+    with adapter_factory("DBReferenceAdapter", config)("repo", config) as adapter:
+        adapter.persist("c1", b"data", "out.yml", kind="cc", subkind="u")
+
+        def broken_connection(*args, **kwargs):
+            raise peewee.InterfaceError("connection already closed")
+
+        monkeypatch.setattr(adapter.db, "execute_sql", broken_connection)
+        with pytest.raises(peewee.InterfaceError):
+            adapter.get_commits(kind="cc", subkind="u")
+        assert adapter.db.is_closed()
+
+        monkeypatch.undo()
+        assert adapter.get_commits(kind="cc", subkind="u") == {"c1"}
+
+
+def test_gc(config):
+    config["gc.batch_size"] = 2
+    now = datetime.utcnow()
+    rows = [
+        # (commit, branch, subkind, age in days)
+        ("recent-feature", "feature", "u", 1),
+        ("old-feature-1", "feature", "u", 20),
+        ("old-feature-2", "feature", "u", 30),
+        ("old-feature-3", "feature", "u", 40),
+        # rows persisted before subkinds were normalized
+        ("old-feature-4", "feature", None, 50),
+        ("old-feature-5", "feature", None, 60),
+        ("recent-master", "master", "u", 10),
+    ]
+    factory = adapter_factory("DBReferenceAdapter", config)
+    with factory("repo", config) as adapter:
+        ReferenceData.insert_many(
+            [
+                dict(
+                    repository_id="repo",
+                    commit_id=commit_id,
+                    kind="cc",
+                    subkind=subkind,
+                    branch=branch,
+                    data=b"x" * 100000,
+                    collected_at=now - timedelta(days=age),
+                    filepath="out.yml",
+                )
+                for commit_id, branch, subkind, age in rows
+            ]
+        ).execute(adapter.db)
+        policy = RetentionPolicy.from_config(config)
+
+        report = adapter.gc(policy, dry_run=True)
+        assert report["rows"] == 5
+        assert report["bytes"] == 5 * 100000
+        assert report["size_after"] is None
+        assert ReferenceData.select().count(adapter.db) == len(rows)
+
+        report = adapter.gc(policy)
+        assert report["rows"] == 5
+        assert report["bytes"] == 5 * 100000
+        assert report["size_after"] <= report["size_before"] - 5 * 100000
+        remaining = {row.commit_id for row in ReferenceData.select().execute(adapter.db)}
+        assert remaining == {"recent-feature", "recent-master"}
@@ -0,0 +1,194 @@
+import http.client
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+import pytest
+
+from magpie.app import adapter_factory, export_references, import_references
+from magpie.cli import require_support
+from magpie.server import DataCache, make_server
+
+
+@contextmanager
+def serving(config):
+    config = dict(config, **{"server.token": "s3cr3t"})
+    server = make_server(
+        adapter_factory("DBReferenceAdapter", config), config, port=0, workers=2
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.fixture
+def server(config):
+    with serving(config) as server:
+        yield server
+
+
+@pytest.fixture
+def client_config(config, server):
+    config = dict(config)
+    config["http.url"] = server.url
+    config["http.token"] = "s3cr3t"
+    return config
+
+
+def http_adapter(config, repository_id="repo/1"):
+    return adapter_factory("HTTPReferenceAdapter", config)(repository_id, config)
+
+
+def test_persist_and_retrieve(client_config):
+    data = b"x" * 200000
+    with http_adapter(client_config) as adapter:
+        adapter.persist("c1", data, "out.yml", branch="master", kind="cc", subkind="u")
+
+        assert adapter.retrieve_data("c1", "cc", "u") == (data, "out.yml")
+        assert adapter.retrieve_data("c0", "cc", "u") == (None, None)
+        assert adapter.get_commits(kind="cc", subkind="u") == {"c1"}
+        assert adapter.log(10) == {"c1": ["cc:u"]}
+
+
+def test_non_ascii_filepath(client_config):
+    with http_adapter(client_config) as adapter:
+        adapter.persist("c1", b"data", "報告/out.yml", kind="cc", subkind="u")
+
+        assert adapter.retrieve_data("c1", "cc", "u") == (b"data", "報告/out.yml")
+        # served again from the local cache, after revalidation
+        assert adapter.retrieve_data("c1", "cc", "u") == (b"data", "報告/out.yml")
+
+
+def test_retrieve_revalidates_the_cached_data(client_config, monkeypatch):
+    with http_adapter(client_config) as adapter:
+        adapter.persist("c1", b"data", "out.yml", kind="cc", subkind="u")
+        assert adapter.retrieve_data("c1", "cc", "u") == (b"data", "out.yml")
+
+        statuses = []
+        request = adapter._request
+
+        def recording_request(*args, **kwargs):
+            response = request(*args, **kwargs)
+            statuses.append(response.status)
+            return response
+
+        monkeypatch.setattr(adapter, "_request", recording_request)
+        assert adapter.retrieve_data("c1", "cc", "u") == (b"data", "out.yml")
+        assert statuses == [304]
+
+
+def test_find_commits_in_batches(client_config):
+    client_config["http.batch_size"] = 2
+    with http_adapter(client_config) as adapter:
+        for commit in ("c1", "c3", "c4"):
+            adapter.persist(commit, b"data", "out.yml", kind="cc", subkind="u")
+
+        found = adapter.find_commits(["c0", "c1", "c2", "c3", "c4"], "cc", "u")
+
+        assert found == {"c1", "c3", "c4"}
+
+
+def test_idle_clients_do_not_lock_out_the_others(client_config):
+    client_config["http.timeout"] = 5
+    idle = [http_adapter(client_config) for _ in range(3)]
+    for adapter in idle:
+        adapter.log()
+
+    with http_adapter(client_config) as adapter:
+        assert adapter.log() == {}
+
+    for adapter in idle:
+        adapter.__exit__(None, None, None)
+
+
+def test_unauthorized(client_config):
+    client_config["http.token"] = "wrong"
+    with http_adapter(client_config) as adapter:
+        with pytest.raises(Exception, match="401"):
+            adapter.log()
+
+
+def test_export_and_import(config, client_config, tmp_path):
+    client_config["archive.batch_size"] = 2
+    for repository_id in ("repo/1", "repo/2"):
+        with http_adapter(client_config, repository_id) as adapter:
+            for commit in ("c1", "c2"):
+                for subkind in ("u", "v", "w"):
+                    data = f"{repository_id}:{commit}:{subkind}".encode("utf-8")
+                    adapter.persist(commit, data, "out.yml", kind="cc", subkind=subkind)
+
+    archive = str(tmp_path / "references.mag")
+    with http_adapter(client_config, None) as adapter:
+        # pages of 2 records, completed up to the end of their group
+        assert export_references(adapter, archive, all_repositories=True) == 12
+    with http_adapter(client_config) as adapter:
+        assert export_references(adapter, archive) == 6
+
+    destination = dict(config, **{"sqlite.dbpath": str(tmp_path / "destination.db")})
+    with serving(destination) as server:
+        destination = dict(client_config, **{"http.url": server.url})
+        with http_adapter(destination, None) as adapter:
+            assert import_references(adapter, archive, batch_size=4) == 6
+        with http_adapter(destination) as adapter:
+            assert adapter.retrieve_data("c2", "cc", "v") == (b"repo/1:c2:v", "out.yml")
+            assert adapter.log() == {
+                "c1": ["cc:u", "cc:v", "cc:w"],
+                "c2": ["cc:u", "cc:v", "cc:w"],
+            }
+
+
+def test_gc_is_not_supported(client_config):
+    with http_adapter(client_config) as adapter:
+        with pytest.raises(click.ClickException, match="does not support"):
+            require_support(adapter, "gc", "gc")
+
+
+def request_status(server, method, path, body=None):
+    host, port = server.server_address[:2]
+    connection = http.client.HTTPConnection(host, port)
+    connection.request(
+        method, path, body=body, headers={"Authorization": "Bearer s3cr3t"}
+    )
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+def test_invalid_limit(server):
+    assert request_status(server, "GET", "/repositories/repo/log?limit=ten") == 400
+
+
+@pytest.mark.parametrize(
+    "body", [b"not json", b"[1]", b'{"commits": "c1"}', b'{"commits": [1]}']
+)
+def test_invalid_presence_body(server, body):
+    path = "/repositories/repo/presence"
+    assert request_status(server, "POST", path, body) == 400
+
+
+@pytest.mark.parametrize(
+    "path", ["references?limit=0", "references?after=c1", 'references?after=["c1"]']
+)
+def test_invalid_references_parameters(server, path):
+    assert request_status(server, "GET", f"/repositories/repo/{path}") == 400
+
+
+def test_invalid_archive(server):
+    path = "/repositories/repo/references"
+    assert request_status(server, "POST", path, b"not an archive") == 400
+
+
+def test_cached_data_expires(monkeypatch):
+    cache = DataCache(size=2, ttl=60)
+    cache.put("key", b"data", "out.yml")
+    assert cache.get("key")[:2] == (b"data", "out.yml")
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert cache.get("key") is None